@@ -1,28 +1,13 @@
-from fbs_runtime.application_context import cached_property
-from fbs_runtime.application_context.PySide2 import ApplicationContext
-from PySide2 import QtGui
-
+import multiprocessing
 import sys
 
-from package.main_window import MainWindow
-
-
-class AppContext(ApplicationContext):
-    def run(self):
-        main_window = MainWindow(ctx=self)
-        main_window.resize(int(1920 / 4), int(1080 / 2))
-        main_window.show()
-        return self.app.exec_()
 
-    @cached_property
-    def img_checked(self):
-        return QtGui.QIcon(self.get_resource('images/checked.png'))
-
-    @cached_property
-    def img_unchecked(self):
-        return QtGui.QIcon(self.get_resource('images/unchecked.png'))
+if __name__ == '__main__':
+    # The images are converted in a pool of processes, which needs this in the frozen application.
+    multiprocessing.freeze_support()
 
+    # Imported here so the processes of the pool, which re-run this module as __mp_main__, don't load Qt.
+    from package.app_context import AppContext
 
-if __name__ == '__main__':
     appctxt = AppContext()
     sys.exit(appctxt.run())
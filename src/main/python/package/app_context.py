@@ -0,0 +1,26 @@
+from fbs_runtime.application_context import cached_property
+from fbs_runtime.application_context.PySide2 import ApplicationContext
+from PySide2 import QtGui
+
+from package.main_window import MainWindow
+
+
+class AppContext(ApplicationContext):
+    def run(self):
+        main_window = MainWindow(ctx=self)
+        main_window.resize(int(1920 / 4), int(1080 / 2))
+        main_window.show()
+        return self.app.exec_()
+
+    @cached_property
+    def style_sheet(self):
+        with open(self.get_resource('style.css'), 'r') as f:
+            return f.read()
+
+    @cached_property
+    def img_checked(self):
+        return QtGui.QIcon(self.get_resource('images/checked.png'))
+
+    @cached_property
+    def img_unchecked(self):
+        return QtGui.QIcon(self.get_resource('images/unchecked.png'))
@@ -1,14 +1,438 @@
+from dataclasses import dataclass
+import functools
+import io
+import logging
+import mmap
 import os
+import queue
+import threading
 
-from PIL import Image
+from PIL import Image, ImageOps, JpegImagePlugin, features, __version__ as PILLOW_VERSION
+
+try:
+    import imagesize
+except ImportError:
+    imagesize = None
+
+try:
+    import numpy
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    _turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _turbo_jpeg = None
+
+logger = logging.getLogger(__name__)
+
+# Pillow 9.1 moved the resampling filters into the Image.Resampling enum.
+LANCZOS = getattr(Image, "Resampling", Image).LANCZOS
+
+# Pillow 8.3 started reading the qtables save option in natural order instead of zigzag order.
+QTABLES_NATURAL_ORDER = tuple(int(part) for part in PILLOW_VERSION.split(".")[:2]) >= (8, 3)
+
+JPEG_EXTENSIONS = (".jpg", ".jpeg", ".jpe", ".jfif")
+
+# The reduction factors libjpeg-turbo can apply while transcoding a JPEG file.
+TRANSCODE_FACTORS = (2, 4, 8)
+
+EXIF_ORIENTATION = 0x0112
+
+# Files from this size are memory mapped instead of read in a single call.
+MMAP_MIN_SIZE = 1024 * 1024
+
+# The standard JPEG quantization tables of the IJG libjpeg (ITU-T T.81 Annex K), in natural order.
+LUMINANCE_QTABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+)
+CHROMINANCE_QTABLE = (
+    17, 18, 24, 47, 99, 99, 99, 99,
+    18, 21, 26, 66, 99, 99, 99, 99,
+    24, 26, 56, 99, 99, 99, 99, 99,
+    47, 66, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+    99, 99, 99, 99, 99, 99, 99, 99,
+)
+
+
+def has_libjpeg_turbo():
+    """Check if the installed Pillow is linked against libjpeg-turbo.
+
+    :return: True if Pillow decodes JPEG files with libjpeg-turbo else False.
+    :rtype: bool
+    """
+    try:
+        return bool(features.check_feature("libjpeg_turbo"))
+    except ValueError:
+        # Pillow versions older than 8.0 do not know this feature.
+        return False
+
+
+HAS_LIBJPEG_TURBO = has_libjpeg_turbo()
+
+if not HAS_LIBJPEG_TURBO:
+    if _turbo_jpeg is None:
+        logger.warning("Pillow is not linked against libjpeg-turbo, JPEG decoding will be slower. "
+                       "Install PyTurboJPEG or rebuild Pillow against a system libjpeg-turbo with: "
+                       "CFLAGS=\"-mavx2\" pip install --no-binary :all: --force-reinstall pillow")
+    else:
+        logger.info("Pillow is not linked against libjpeg-turbo, JPEG files are decoded with PyTurboJPEG.")
+
+
+def is_pillow_simd():
+    """Check if the installed Pillow is the SIMD accelerated Pillow-SIMD fork.
+
+    :return: True if Pillow-SIMD is installed else False.
+    :rtype: bool
+    """
+    # Pillow-SIMD releases are tagged as post releases of the matching Pillow version.
+    return ".post" in PILLOW_VERSION
+
+
+IS_PILLOW_SIMD = is_pillow_simd()
+logger.info("Resizing images with %s %s.", "Pillow-SIMD" if IS_PILLOW_SIMD else "Pillow", PILLOW_VERSION)
+
+
+def read_file(path):
+    """Read the content of a file in a single call, or memory map it when it is large.
+
+    The decoders then get one contiguous buffer instead of going through buffered reads.
+
+    :param path: The path of the file.
+    :type path: str
+
+    :return: The content of the file.
+    :rtype: bytes or mmap.mmap
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < MMAP_MIN_SIZE:
+            return f.read()
+
+        # The mapping stays valid once the file is closed, it is released with the image.
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def open_image(path, draft_size=None, data=None):
+    """Open an image file, decoding JPEG files with libjpeg-turbo when Pillow can't.
+
+    :param path: The path of the image file.
+    :param draft_size: The smallest size needed, JPEG files decoded by libjpeg-turbo are scaled like Image.draft does.
+    :param data: The content of the image file when it is already read by read_file.
+    :type path: str
+    :type draft_size: tuple
+    :type data: bytes or mmap.mmap
+
+    :return: The image object from PIL.
+    :rtype: Image
+    """
+    if data is None:
+        data = read_file(path)
+
+    if _turbo_jpeg is not None and not HAS_LIBJPEG_TURBO and path.lower().endswith(JPEG_EXTENSIONS):
+        header = _open_data(data)
+
+        # Other modes, like grayscale, are left to Pillow so the reduced image keeps the mode of the source.
+        if header.mode == "RGB":
+            scale = draft_scale(header.size, draft_size) if draft_size else 1
+            try:
+                image = Image.fromarray(_turbo_jpeg.decode(data, pixel_format=TJPF_RGB, scaling_factor=(1, scale)))
+            except OSError:
+                logger.debug("PyTurboJPEG failed to decode %s, falling back to Pillow.", path)
+            else:
+                # Keep the EXIF metadata parsed from the header by Pillow, reduce_image needs the orientation.
+                exif = header.info.get("exif")
+                if exif:
+                    image.info["exif"] = exif
+                return image
+
+    return _open_data(data)
+
+
+def draft_scale(size, draft_size):
+    """Choose the DCT domain downscale of a JPEG file the same way as Image.draft.
+
+    :param size: The size of the image.
+    :param draft_size: The smallest size needed.
+    :type size: tuple
+    :type draft_size: tuple
+
+    :return: The downscale factor, 1, 2, 4 or 8.
+    :rtype: int
+    """
+    scale = min(size[0] // draft_size[0], size[1] // draft_size[1])
+    for factor in (8, 4, 2):
+        if scale >= factor:
+            return factor
+    return 1
+
+
+def _open_data(data):
+    """Open an image from the content of its file.
+
+    :param data: The content of the image file.
+    :type data: bytes or mmap.mmap
+
+    :return: The image object from PIL.
+    :rtype: Image
+    """
+    if isinstance(data, mmap.mmap):
+        data.seek(0)
+        return Image.open(data)
+    return Image.open(io.BytesIO(data))
+
+
+def read_image_size(path):
+    """Read the size of an image from the header of its file, without decoding it.
+
+    :param path: The path of the image file.
+    :type path: str
+
+    :return: The width and the height of the image.
+    :rtype: tuple
+    """
+    if imagesize is not None:
+        width, height = imagesize.get(path)
+        # imagesize returns -1 for the formats it doesn't know.
+        if width > 0 and height > 0:
+            return width, height
+
+    with Image.open(path) as image:
+        return image.size
+
+
+def compute_qtables(quality=75):
+    """Scale the standard quantization tables for a quality, the same way libjpeg does.
+
+    :param quality: The percentage of quality.
+    :type quality: int
+
+    :return: The luminance and chrominance quantization tables.
+    :rtype: list
+    """
+    quality = min(max(quality, 1), 100)
+    scale = 5000 // quality if quality < 50 else 200 - quality * 2
+    return [[min(max((value * scale + 50) // 100, 1), 255) for value in qtable]
+            for qtable in (LUMINANCE_QTABLE, CHROMINANCE_QTABLE)]
+
+
+def jpeg_save_kwargs(quality=75):
+    """Build the JPEG save options of Pillow for a quality, so a batch computes them only once.
+
+    :param quality: The percentage of quality.
+    :type quality: int
+
+    :return: The keyword arguments of Image.save.
+    :rtype: dict
+    """
+    # optimize is left off, it is slower and known to produce artifacts with some decoders.
+    # The EXIF metadata and the ICC profile are not copied to the reduced image, and the chroma is subsampled in 4:2:0.
+    save_kwargs = {"format": "JPEG", "optimize": False, "progressive": False,
+                   "exif": b"", "icc_profile": None, "subsampling": 2}
+
+    # The quality is already applied to the tables, passing it too would make libjpeg scale them again. Older Pillow
+    # versions would read the tables in the wrong order, so they get the quality instead.
+    if QTABLES_NATURAL_ORDER:
+        save_kwargs["qtables"] = compute_qtables(quality)
+    else:
+        save_kwargs["quality"] = quality
+    return save_kwargs
+
+
+def encode_jpeg(image, quality=75):
+    """Encode an RGB image with the SIMD color conversion, DCT and quantization of libjpeg-turbo when Pillow can't.
+
+    :param image: The image object from PIL.
+    :param quality: The percentage of quality.
+    :type image: Image
+    :type quality: int
+
+    :return: The JPEG data, or None if the image has to be saved with Pillow.
+    :rtype: bytes
+    """
+    if _turbo_jpeg is None or HAS_LIBJPEG_TURBO or image.mode != "RGB":
+        return None
+
+    # Same 4:2:0 chroma subsampling as Pillow.
+    return _turbo_jpeg.encode(numpy.asarray(image), quality=quality, pixel_format=TJPF_RGB,
+                              jpeg_subsample=TJSAMP_420)
+
+
+def transcode_jpeg(path, data, factor, quality=75):
+    """Scale a JPEG file in the DCT domain with libjpeg-turbo, without a full resolution RGB round trip.
+
+    libjpeg rounds the scaled size up, the caller checks it matches the size of the Pillow pipeline.
+
+    :param path: The path of the JPEG file.
+    :param data: The content of the JPEG file, read by read_file.
+    :param factor: The reduction factor, one of TRANSCODE_FACTORS.
+    :param quality: The percentage of quality.
+    :type path: str
+    :type data: bytes or mmap.mmap
+    :type factor: int
+    :type quality: int
+
+    :return: The JPEG data, or None if the image has to go through the full pipeline.
+    :rtype: bytes
+    """
+    if _turbo_jpeg is None:
+        return None
+
+    try:
+        # The header image is not closed, it would close a memory mapped file the full pipeline still needs.
+        header = _open_data(data)
+
+        # The transcoding drops the EXIF metadata, so rotated images go through the full pipeline.
+        if header.getexif().get(EXIF_ORIENTATION, 1) != 1:
+            return None
+
+        # The transcoding keeps the chroma subsampling of the source, the full pipeline subsamples in 4:2:0.
+        if header.mode != "L" and JpegImagePlugin.get_sampling(header) != 2:
+            return None
+
+        return _turbo_jpeg.scale_with_quality(data, scaling_factor=(1, factor), quality=quality)
+    except (OSError, AttributeError):
+        # AttributeError: PyTurboJPEG versions without scale_with_quality.
+        logger.debug("PyTurboJPEG failed to transcode %s, falling back to Pillow.", path)
+        return None
+
+
+def write_file(path, data):
+    """Write encoded data to a file with a single open and as few write system calls as possible.
+
+    :param path: The path of the file.
+    :param data: The data to write.
+    :type path: str
+    :type data: bytes
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+class FileWriter:
+    """The FileWriter class writes files on a background thread, so encoding the next image never waits for the disk.
+
+    Attributes:
+        **queue** *(queue.Queue)*: The bounded queue of the pending writes.
+
+        **thread** *(threading.Thread)*: The thread writing the files.
+    """
+
+    def __init__(self, maxsize=8):
+        """The constructor of the file writer, which starts its thread.
+
+        :param maxsize: The maximum number of pending writes before write blocks.
+        :type maxsize: int
+        """
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        """Write the queued files until close is called."""
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    break
+
+                path, data, callback = job
+                try:
+                    write_file(path, data)
+                    success = True
+                except OSError:
+                    success = False
+
+                if callback is not None:
+                    callback(success)
+            finally:
+                self.queue.task_done()
+
+    def write(self, path, data, callback=None):
+        """Queue a file to write, blocking while the queue is full.
+
+        :param path: The path of the file.
+        :param data: The data to write.
+        :param callback: The function called with True if the file is written else False.
+        :type path: str
+        :type data: bytes
+        :type callback: callable
+        """
+        self.queue.put((path, data, callback))
+
+    def clear(self):
+        """Drop the pending writes, their callbacks are not called."""
+        while True:
+            try:
+                job = self.queue.get_nowait()
+            except queue.Empty:
+                break
+
+            self.queue.task_done()
+            if job is None:
+                # Keep the request of close to stop the thread.
+                self.queue.put(None)
+                break
+
+    def close(self):
+        """Wait for the pending writes and stop the thread."""
+        self.queue.put(None)
+        self.thread.join()
+
+
+@dataclass(frozen=True)
+class ResizeSpec:
+    """The ResizeSpec class holds the reduction size as a fraction, so integer factors are detected exactly.
+
+    Attributes:
+        **num** *(int)*: The numerator of the reduction size.
+
+        **den** *(int)*: The denominator of the reduction size.
+    """
+
+    num: int
+    den: int
+
+    @property
+    def factor(self):
+        """The integer reduction factor, or None if the size is not the inverse of an integer.
+
+        :rtype: int
+        """
+        return self.den // self.num if self.den % self.num == 0 else None
+
+    @functools.lru_cache(maxsize=64)
+    def scale(self, width, height):
+        """Compute the reduced size of an image, cached since the images of a batch often share their size.
+
+        :param width: The width of the image.
+        :param height: The height of the image.
+        :type width: int
+        :type height: int
+
+        :return: The reduced width and height.
+        :rtype: tuple
+        """
+        return max(1, width * self.num // self.den), max(1, height * self.num // self.den)
 
 
 class CustomImage:
     """The CustomImage class implements the image reduction size and quality operation..
 
-    Attributes:
-        **image** *(Image)*: The image object from PIL.
+    The image is only opened and decoded by reduce_image, the constructor reads its size from the file header.
 
+    Attributes:
         **width** *(int)*: The width of the image.
 
         **height** *(int)*: The height of the image.
@@ -18,6 +442,9 @@ class CustomImage:
         **reduced_path** *(str)*: The path of the reduced image.
     """
 
+    # One instance is created per image of a batch, slots avoid the memory and lookups of an instance dictionary.
+    __slots__ = ("width", "height", "path", "reduced_path")
+
     def __init__(self, path, folder="reduced"):
         """The constructor of the custom image object.
 
@@ -26,31 +453,103 @@ class CustomImage:
         :type path: str
         :type folder: str
         """
-        self.image = Image.open(path)
-        self.width, self.height = self.image.size
+        self.width, self.height = read_image_size(path)
         self.path = path
         self.reduced_path = os.path.join(os.path.dirname(self.path),
                                          folder,
                                          os.path.basename(self.path))
 
-    def reduce_image(self, size=0.5, quality=75):
+    def reduce_image(self, spec=ResizeSpec(1, 2), quality=75, save_kwargs=None, writer=write_file):
         """Set the size and the quality of the image.
 
-        :param size: The reduction size coefficient.
+        The output folder must already exist, it is created once per batch by the caller.
+
+        :param spec: The reduction size.
         :param quality: The percentage of quality.
-        :type size: float
+        :param save_kwargs: The JPEG save options computed by jpeg_save_kwargs for this quality.
+        :param writer: The function called with the path and the data of the reduced image, like FileWriter.write.
+        :type spec: ResizeSpec
         :type quality: int
+        :type save_kwargs: dict
+        :type writer: callable
 
-        :return: True if the path of the reduced image exists else False.
+        :return: True if the reduced image is saved, or handed to the writer, else False.
         :rtype: bool
         """
-        new_width = round(self.width * size)
-        new_height = round(self.height * size)
-        self.image = self.image.resize((new_width, new_height), Image.ANTIALIAS)
-        parent_dir = os.path.dirname(self.reduced_path)
+        new_width, new_height = spec.scale(self.width, self.height)
+        source_data = None
+
+        # libjpeg rounds the transcoded size up, so only transcode when it matches the size of the full pipeline.
+        if (spec.factor in TRANSCODE_FACTORS and self.path.lower().endswith(JPEG_EXTENSIONS)
+                and (-(-self.width // spec.factor), -(-self.height // spec.factor)) == (new_width, new_height)):
+            source_data = read_file(self.path)
+            data = transcode_jpeg(self.path, source_data, spec.factor, quality)
+            if data is not None:
+                try:
+                    writer(self.reduced_path, data)
+                except OSError:
+                    return False
+                return True
+
+        # For JPEG files, let libjpeg downscale by 1/2, 1/4 or 1/8 in the DCT domain while decoding, through
+        # Image.draft or the libjpeg-turbo decoder. Twice the target size is kept for the final resampling, except for
+        # the smallest sizes where the 1/8 scale is used directly.
+        if spec.num * 8 <= spec.den:
+            draft_size = (new_width, new_height)
+        else:
+            draft_size = (new_width * 2, new_height * 2)
 
-        if not os.path.exists(parent_dir):
-            os.makedirs(parent_dir)
+        # The file and the decoded image are released as soon as the reduced image is encoded.
+        with open_image(self.path, draft_size, source_data) as image:
+            orientation = image.getexif().get(EXIF_ORIENTATION, 1)
+            image.draft("RGB", draft_size)
 
-        self.image.save(self.reduced_path, 'JPEG', quality=quality)
-        return os.path.exists(self.reduced_path)
+            # The EXIF metadata is not copied to the reduced image, so bake the orientation into the pixels.
+            if orientation != 1:
+                image = ImageOps.exif_transpose(image)
+                if orientation in (5, 6, 7, 8):
+                    new_width, new_height = new_height, new_width
+
+            # Integer ratios, like the residual 1/2 left by the draft, use the much cheaper box filter of Image.reduce.
+            width, height = image.size
+            factor = round(width / new_width)
+            if factor > 1 and (-(-width // factor), -(-height // factor)) == (new_width, new_height):
+                image = image.reduce(factor)
+            elif image.size != (new_width, new_height):
+                image = image.resize((new_width, new_height), LANCZOS)
+
+            try:
+                data = encode_jpeg(image, quality=quality)
+                if data is None:
+                    buffer = io.BytesIO()
+                    image.save(buffer, **(save_kwargs or jpeg_save_kwargs(quality)))
+                    data = buffer.getbuffer()
+            except OSError:
+                return False
+
+        try:
+            writer(self.reduced_path, data)
+        except OSError:
+            return False
+        return True
+
+
+def convert_image(path, folder="reduced", spec=ResizeSpec(1, 2), quality=75, save_kwargs=None):
+    """Reduce an image file, as a top-level function so it can be sent to a process pool.
+
+    :param path: The path of the image file.
+    :param folder: The name of the output folder.
+    :param spec: The reduction size.
+    :param quality: The percentage of quality.
+    :param save_kwargs: The JPEG save options computed by jpeg_save_kwargs for this quality.
+    :type path: str
+    :type folder: str
+    :type spec: ResizeSpec
+    :type quality: int
+    :type save_kwargs: dict
+
+    :return: True if the reduced image is saved else False.
+    :rtype: bool
+    """
+    image = CustomImage(path=path, folder=folder)
+    return image.reduce_image(spec=spec, quality=quality, save_kwargs=save_kwargs)
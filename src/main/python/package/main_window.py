@@ -1,6 +1,18 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import functools
+import os
+import threading
+
 from PySide2 import QtWidgets, QtCore, QtGui
 
-from package.image import CustomImage
+from package.image import CustomImage, FileWriter, ResizeSpec, convert_image, jpeg_save_kwargs
+
+# Under this number of images, starting the processes costs more than it saves.
+PROCESS_POOL_MIN_IMAGES = 16
+
+# The progress bar and the list are repainted every PROGRESS_BATCH converted images, or after PROGRESS_DELAY ms.
+PROGRESS_BATCH = 16
+PROGRESS_DELAY = 50
 
 
 class Worker(QtCore.QObject):
@@ -9,35 +21,137 @@ class Worker(QtCore.QObject):
     image_converted = QtCore.Signal(object, bool)
     finished = QtCore.Signal()
 
-    def __init__(self, images_to_convert, quality, size, folder):
+    def __init__(self, images_to_convert, quality, spec, folder):
         """The constructor of the worker.
 
-        :param images_to_convert: The images items to process.
+        :param images_to_convert: The unprocessed images items to process.
         :param quality: The percentage of quality.
-        :param size: The reduction size coefficient.
+        :param spec: The reduction size.
         :param folder: The name of the output folder.
-        :type images_to_convert: QWidgets.QListWidgetItem
+        :type images_to_convert: list
         :type quality: int
-        :type size: float
+        :type spec: ResizeSpec
         :type folder: str
         """
         super().__init__()
         self.images_to_convert = images_to_convert
         self.quality = quality
-        self.size = size
+        self.save_kwargs = jpeg_save_kwargs(quality)
+        self.spec = spec
         self.folder = folder
-        self.runs = True
+        self.stop_event = threading.Event()
+        self.futures = []
+        self.file_writer = None
 
     def convert_images(self):
-        """Convert the all the images of the list."""
-        for image_lw_item in self.images_to_convert:
-            if self.runs and not image_lw_item.processed:
-                image = CustomImage(path=image_lw_item.text(), folder=self.folder)
-                success = image.reduce_image(size=self.size, quality=self.quality)
-                self.image_converted.emit(image_lw_item, success)
+        """Convert the all the images of the list in a pool of threads or processes.
+
+        The worker thread only dispatches the images to the pool and reports the results, the signals emitted here
+        are queued to the user interface thread by Qt.
+        """
+        lw_items = self.images_to_convert
+        self.create_output_dirs(lw_items)
+        if len(lw_items) < PROCESS_POOL_MIN_IMAGES:
+            self.convert_images_in_threads(lw_items)
+        else:
+            self.convert_images_in_processes(lw_items)
 
         self.finished.emit()
 
+    def create_output_dirs(self, lw_items):
+        """Create the output folders once for the batch instead of checking them for every image.
+
+        :param lw_items: The unprocessed images items.
+        :type lw_items: list
+        """
+        output_dirs = {os.path.join(os.path.dirname(lw_item.text()), self.folder) for lw_item in lw_items}
+        for output_dir in output_dirs:
+            try:
+                os.makedirs(output_dir, exist_ok=True)
+            except OSError:
+                # The images of this folder will fail to save and be reported as not converted.
+                pass
+
+    def convert_images_in_threads(self, lw_items):
+        """Convert the images in a pool of threads, one per core.
+
+        Pillow and the ctypes calls of PyTurboJPEG release the GIL while decoding, resizing and encoding, so the
+        threads only serialize on the small amount of Python glue around them. The encoded images are written by a
+        dedicated thread, which reports them once they are on the disk.
+
+        :param lw_items: The unprocessed images items.
+        :type lw_items: list
+        """
+        paths = [lw_item.text() for lw_item in lw_items]
+        self.file_writer = FileWriter()
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            for lw_item, success in zip(lw_items, pool.map(self._process, lw_items, paths)):
+                if success is not None:
+                    self.image_converted.emit(lw_item, success)
+
+        self.file_writer.close()
+
+    def convert_images_in_processes(self, lw_items):
+        """Convert the images in a pool of processes and report them as they complete.
+
+        :param lw_items: The unprocessed images items.
+        :type lw_items: list
+        """
+        with ProcessPoolExecutor() as pool:
+            futures = {}
+            for lw_item in lw_items:
+                if self.stop_event.is_set():
+                    break
+
+                future = pool.submit(convert_image, lw_item.text(), self.folder, self.spec, self.quality,
+                                     self.save_kwargs)
+                futures[future] = lw_item
+                self.futures.append(future)
+
+            for future in as_completed(futures):
+                if future.cancelled():
+                    continue
+
+                try:
+                    success = future.result()
+                except (OSError, ValueError):
+                    success = False
+                self.image_converted.emit(futures[future], success)
+
+    def _process(self, lw_item, path):
+        """Convert one image and queue it to the file writer unless the conversion has been aborted.
+
+        :param lw_item: The image item.
+        :param path: The path of the image file.
+        :type lw_item: QWidgets.QListWidgetItem
+        :type path: str
+
+        :return: False if it failed, None if it was skipped or queued to be reported by the file writer.
+        :rtype: bool
+        """
+        if self.stop_event.is_set():
+            return None
+
+        callback = functools.partial(self.image_converted.emit, lw_item)
+        writer = functools.partial(self.file_writer.write, callback=callback)
+        try:
+            image = CustomImage(path=path, folder=self.folder)
+            if image.reduce_image(spec=self.spec, quality=self.quality, save_kwargs=self.save_kwargs,
+                                  writer=writer):
+                return None
+        except (OSError, ValueError):
+            pass
+        return False
+
+    def abort(self):
+        """Stop submitting images and cancel the pending ones."""
+        self.stop_event.set()
+        for future in self.futures:
+            future.cancel()
+
+        if self.file_writer is not None:
+            self.file_writer.clear()
+
 
 class MainWindow(QtWidgets.QWidget):
     """This is a class to create the window of the application."""
@@ -50,6 +164,8 @@ class MainWindow(QtWidgets.QWidget):
         """
         super().__init__()
         self.ctx = ctx
+        self.paths = set()
+        self.done_count = 0
         self.setWindowTitle("pyConverter")
         self.setup_ui()
 
@@ -72,12 +188,11 @@ class MainWindow(QtWidgets.QWidget):
         self.lw_files = QtWidgets.QListWidget()
         self.btn_convert = QtWidgets.QPushButton("Convert")
         self.lbl_dropInfo = QtWidgets.QLabel("^ Drop your images on the UI")
+        self.tmr_progress = QtCore.QTimer(self)
 
     def modify_widgets(self):
         """Apply a CSS style sheet to the user interface of the application and modify the widgets."""
-        css_file = self.ctx.get_resource("style.css")
-        with open(css_file, "r") as f:
-            self.setStyleSheet(f.read())
+        self.setStyleSheet(self.ctx.style_sheet)
 
         # Alignment
         self.spn_quality.setAlignment(QtCore.Qt.AlignRight)
@@ -102,6 +217,10 @@ class MainWindow(QtWidgets.QWidget):
         self.lw_files.setAlternatingRowColors(True)
         self.lw_files.setSelectionMode(QtWidgets.QListWidget.ExtendedSelection)
 
+        # Progress
+        self.tmr_progress.setSingleShot(True)
+        self.tmr_progress.setInterval(PROGRESS_DELAY)
+
     def create_layouts(self):
         """Create the grid layout of the user interface."""
         self.main_layout = QtWidgets.QGridLayout(self)
@@ -122,15 +241,16 @@ class MainWindow(QtWidgets.QWidget):
         """Setup the connections."""
         QtWidgets.QShortcut(QtGui.QKeySequence('Backspace'), self.lw_files, self.delete_selected_items)
         self.btn_convert.clicked.connect(self.convert_images)
+        self.tmr_progress.timeout.connect(self.update_progress)
 
     def convert_images(self):
         """Convert the images in the list using threading."""
         quality = self.spn_quality.value()
-        size = self.spn_size.value() / 100.0
+        spec = ResizeSpec(self.spn_size.value(), 100)
         folder = self.le_outputDir.text() or "reduced"
 
-        lw_items = [self.lw_files.item(index) for index in range(self.lw_files.count())]
-        images_to_convert = [1 for lw_item in lw_items if not lw_item.processed]
+        images_to_convert = [lw_item for lw_item in map(self.lw_files.item, range(self.lw_files.count()))
+                             if not lw_item.processed]
         if not images_to_convert:
             msg_box = QtWidgets.QMessageBox(QtWidgets.QMessageBox.Warning,
                                             "No image to convert",
@@ -138,17 +258,19 @@ class MainWindow(QtWidgets.QWidget):
             msg_box.exec_()
             return False
 
+        self.done_count = 0
         self.thread = QtCore.QThread(self)
 
-        self.worker = Worker(images_to_convert=lw_items,
+        self.worker = Worker(images_to_convert=images_to_convert,
                              quality=quality,
-                             size=size,
+                             spec=spec,
                              folder=folder)
 
         self.worker.moveToThread(self.thread)
         self.worker.image_converted.connect(self.image_converted)
         self.thread.started.connect(self.worker.convert_images)
         self.worker.finished.connect(self.thread.quit)
+        self.worker.finished.connect(self.update_progress)
         self.thread.start()
 
         self.prg_dialog = QtWidgets.QProgressDialog("Convert images", "Cancel", 1, len(images_to_convert))
@@ -158,7 +280,7 @@ class MainWindow(QtWidgets.QWidget):
     def abort(self):
         """Stop the thread."""
         self.thread.quit()
-        self.worker.runs = False
+        self.worker.abort()
 
     def image_converted(self, lw_item, success):
         """Update the image item icon and the progress bar.
@@ -169,13 +291,29 @@ class MainWindow(QtWidgets.QWidget):
         :type success: bool
         """
         if success:
+            # Hold the list repaints until the next progress update.
+            self.lw_files.setUpdatesEnabled(False)
             lw_item.setIcon(self.ctx.img_checked)
             lw_item.processed = True
-            self.prg_dialog.setValue(self.prg_dialog.value() + 1)
+            self.done_count += 1
+
+            if self.done_count - max(self.prg_dialog.value(), 0) >= PROGRESS_BATCH:
+                self.update_progress()
+            elif not self.tmr_progress.isActive():
+                self.tmr_progress.start()
+
+    def update_progress(self):
+        """Show the converted images in the progress bar and repaint the list."""
+        self.tmr_progress.stop()
+        # Updating a cancelled dialog would show it again.
+        if not self.prg_dialog.wasCanceled():
+            self.prg_dialog.setValue(self.done_count)
+        self.lw_files.setUpdatesEnabled(True)
 
     def delete_selected_items(self):
         """Remove selected image item from the list."""
         for lw_item in self.lw_files.selectedItems():
+            self.paths.discard(lw_item.text())
             row = self.lw_files.row(lw_item)
             self.lw_files.takeItem(row)
 
@@ -204,8 +342,11 @@ class MainWindow(QtWidgets.QWidget):
         :type event: QtGui.QDropEvent
         """
         event.accept()
+        # Coalesce the repaints of the list when a lot of files are dropped.
+        self.lw_files.setUpdatesEnabled(False)
         for url in event.mimeData().urls():
             self.add_file(path=url.toLocalFile())
+        self.lw_files.setUpdatesEnabled(True)
 
         self.lbl_dropInfo.setVisible(False)
 
@@ -215,9 +356,9 @@ class MainWindow(QtWidgets.QWidget):
         :param path: The path of the image file.
         :type path: str
         """
-        items = [self.lw_files.item(index).text() for index in range(self.lw_files.count())]
-        if path not in items:
+        if path not in self.paths:
             lw_item = QtWidgets.QListWidgetItem(path)
             lw_item.setIcon(self.ctx.img_unchecked)
             lw_item.processed = False
             self.lw_files.addItem(lw_item)
+            self.paths.add(path)